@@ -8,5 +8,5 @@ setup(
     description="IBKR API Client and some tools",
     packages=["ib_sync", "ibapi", "mcal", "mcal.rules"],
     package_dir={"": "src"},
-    install_requires=["pandas_market_calendars ~= 4.1, < 5"],
+    install_requires=["numpy", "pandas_market_calendars ~= 4.1, < 5"],
 )
@@ -1,6 +1,8 @@
 import logging
+import os
 import threading
-from datetime import datetime
+from collections import defaultdict
+from datetime import datetime, timedelta
 
 from ibapi.client import EClient
 from ibapi.wrapper import EWrapper
@@ -9,14 +11,18 @@ from ibapi.wrapper import EWrapper
 log = logging.getLogger("ib_api.client")
 log.setLevel(logging.INFO)
 
+EPOCH = datetime(1970, 1, 1)
+
 
 class IBClient(EWrapper, EClient):
     def __init__(self):
         EClient.__init__(self, self)
         self.nextValidOrderId: int = -1
         self.account_id: str = ""
-        self.values: dict = {}
-        self.tws_time: datetime = datetime.min
+        self.values: defaultdict[str, dict] = defaultdict(dict)
+        # Значения аккаунта копятся до updateAccountTime
+        self._pending_values: defaultdict[str, list] = defaultdict(list)
+        self.tws_timestamp: int = 0
 
     def connectAck(self):
         """
@@ -24,12 +30,14 @@ class IBClient(EWrapper, EClient):
         Connection handshake not complete until nextValidID is received.
         """
         super().connectAck()
-        log.warn("Connection attempt...")
+        log.warning("Connection attempt...")
 
     def connectionClosed(self):
         super().connectionClosed()
         self.nextValidOrderId = -1
-        log.warn("connectionClosed")
+        # Недописанная пачка значений аккаунта осталась от старого соединения
+        self._pending_values = defaultdict(list)
+        log.warning("connectionClosed")
 
     def nextValidId(self, orderId):
         self.nextValidOrderId = orderId
@@ -39,32 +47,78 @@ class IBClient(EWrapper, EClient):
         Receives a comma-separated string with the managed account ids.
         """
         super().managedAccounts(accountsList)
-        self.account_id = accountsList.split(",")[0]
+        self.account_id = accountsList.partition(",")[0]
         # Это событие приходит после соединения.
         # Сбрасываю старые значения аккаунта.
         self.values[self.account_id] = {}
-        log.info(f"Managed account: {self.account_id}")
+        self._pending_values.pop(self.account_id, None)
+        log.info("Managed account: %s", self.account_id)
 
     def updateAccountValue(self, key, value, currency, accountName):
-        self.values[accountName][key] = value
+        self._pending_values[accountName].append((key, value))
+
+    def updateAccountTime(self, timeStamp: str):
+        """
+        TWS присылает время после пачки updateAccountValue.
+        """
+        super().updateAccountTime(timeStamp)
+        self._flush_account_values()
+
+    def accountDownloadEnd(self, accountName: str):
+        super().accountDownloadEnd(accountName)
+        self._flush_account_values()
+
+    def _flush_account_values(self):
+        pending, self._pending_values = self._pending_values, defaultdict(list)
+        account_values = self.values
+        for accountName, values in pending.items():
+            account_values[accountName].update(values)
 
     def orderBound(self, orderId: int, apiClientId: int, apiOrderId: int):
         super().orderBound(orderId, apiClientId, apiOrderId)
         log.error(
-            f"OrderBound. OrderId: {orderId}, "
-            f"ApiClientId: {apiClientId}, "
-            f"ApiOrderId: {apiOrderId}"
+            "OrderBound. OrderId: %s, ApiClientId: %s, ApiOrderId: %s",
+            orderId,
+            apiClientId,
+            apiOrderId,
         )
 
+    @property
+    def tws_time(self) -> datetime | None:
+        """
+        Время TWS (UTC, naive), datetime собирается только при чтении.
+        None, пока TWS не прислал время.
+        """
+        if not self.tws_timestamp:
+            return None
+        return EPOCH + timedelta(seconds=self.tws_timestamp)
+
     def currentTime(self, time):
-        self.tws_time = datetime.utcfromtimestamp(time)
+        self.tws_timestamp = time
 
 
 class IBThread(threading.Thread):
-    def __init__(self, app):
+    def __init__(self, app, cpu: int | None = None):
+        """
+        cpu: ядро для потока сообщений (Linux), например ядро,
+        на которое приходят прерывания сетевой карты (ethtool -x).
+        """
         self.app = app
+        self.cpu = cpu
+        self._running = threading.Event()
         super().__init__(target=self.run, daemon=True, name="IBThread")
 
+    def start(self):
+        # Пока run_thread_id не выставлен, IBSync разбирает очередь сам
+        # и может забрать сообщения, которые ждет run()
+        super().start()
+        self._running.wait()
+
     def run(self):
         log.info("Run Message Thread")
+        self.app.run_thread_id = threading.get_ident()
+        self._running.set()
+        if self.cpu is not None and hasattr(os, "sched_setaffinity"):
+            # pid 0 - текущий поток
+            os.sched_setaffinity(0, {self.cpu})
         self.app.run()
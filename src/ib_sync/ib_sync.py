@@ -1,10 +1,14 @@
-import inspect
 import logging
 import queue
-import random
+import sys
+import threading
+from collections import defaultdict
+from copy import copy
 from dataclasses import dataclass, fields, is_dataclass
-from datetime import date, datetime, timedelta
+from datetime import date, datetime
 from decimal import Decimal
+from functools import lru_cache
+from itertools import count
 from time import monotonic, sleep
 
 from ibapi.comm import read_fields
@@ -12,6 +16,8 @@ from ibapi.common import BarData, TickerId
 from ibapi.contract import Contract as IbContract
 from ibapi.contract import ContractDetails
 from ibapi.execution import ExecutionFilter
+from ibapi.order import Order
+from ibapi.order_state import OrderState
 
 from .client import IBClient
 
@@ -26,22 +32,45 @@ logging.getLogger("ibapi.wrapper").setLevel(logging.WARNING)
 
 TIMEOUT = 5.0
 
+# Старые запросы удаляются из Results раз в минуту
+REQUESTS_GC_INTERVAL = 60.0
+REQUESTS_TTL = 600.0
+
+# Пустой фильтр: все сделки. reqExecutions его только читает
+EMPTY_EXEC_FILTER = ExecutionFilter()
+
+# TWS принимает не больше 50 сообщений в секунду,
+# детали контрактов запрашиваются пачками такого размера
+DETAILS_BATCH_SIZE = 50
+
+# TWS допускает не больше 50 одновременных запросов истории
+HISTORICAL_MAX_REQUESTS = 50
+
+# Имена и значения по умолчанию полей dataclass, по классу
+_FIELD_DEFAULTS: dict[type, tuple] = {}
+
 
 def dataclassNonDefaults(obj) -> dict:
     """
     For a ``dataclass`` instance get the fields that are different from the
     default values and return as ``dict``.
     """
-    if not is_dataclass(obj):
-        raise TypeError(f"Object {obj} is not a dataclass")
-    values = [getattr(obj, field.name) for field in fields(obj)]
-    return {
-        field.name: value
-        for field, value in zip(fields(obj), values)
-        if value != field.default
-        and value == value
-        and not (isinstance(value, list) and value == [])
-    }
+    cls = type(obj)
+    defaults = _FIELD_DEFAULTS.get(cls)
+    if defaults is None:
+        if not is_dataclass(obj):
+            raise TypeError(f"Object {obj} is not a dataclass")
+        defaults = tuple((field.name, field.default) for field in fields(obj))
+        _FIELD_DEFAULTS[cls] = defaults
+    res = {}
+    for name, default in defaults:
+        value = getattr(obj, name)
+        if value == default or value != value:
+            continue
+        if isinstance(value, list) and not value:
+            continue
+        res[name] = value
+    return res
 
 
 @dataclass
@@ -66,24 +95,34 @@ class Contract(IbContract):
     comboLegsDescrip: str = ""
     comboLegs: None = None
     deltaNeutralContract: None = None
+    # Заполняется в qualify_contract
+    details: ContractDetails | None = None
 
     def __eq__(self, other):
         if not isinstance(other, Contract):
             return False
         if bool(self.conId) and self.conId == other.conId:
             return True
-        return hash(self) == hash(other)
+        if self.conId or other.conId:
+            return False
+        return contract_key(self) == contract_key(other)
 
     def __hash__(self):
         if self.conId:
             # CONTFUT gets the same conId as the front contract, invert it here
             h = self.conId if self.secType != "CONTFUT" else -self.conId
         else:
-            self_str = (
-                "{secType}-{conId}-{symbol}-{lastTradeDateOrContractMonth}-"
-                "{exchange}-{primaryExchange}-{currency}-{localSymbol}"
-            ).format(**self.__dict__)
-            h = hash(self_str)
+            h = hash(
+                (
+                    self.secType,
+                    self.symbol,
+                    self.lastTradeDateOrContractMonth,
+                    self.exchange,
+                    self.primaryExchange,
+                    self.currency,
+                    self.localSymbol,
+                )
+            )
         # log.info(f"conid, {self.conId}, h: {h}")
         return int(h)
 
@@ -99,12 +138,29 @@ class Contract(IbContract):
     __str__ = __repr__
 
 
+def contract_key(contract: IbContract) -> tuple:
+    """
+    Ключ кэша деталей: conId, а без него - поля, из которых считается hash.
+    """
+    if contract.conId:
+        return (contract.conId,)
+    return (
+        contract.secType,
+        contract.symbol,
+        contract.lastTradeDateOrContractMonth,
+        contract.exchange,
+        contract.primaryExchange,
+        contract.currency,
+        contract.localSymbol,
+    )
+
+
 class Timer:
     def __init__(self, timeout: float = TIMEOUT):
-        stack = inspect.stack()
-        fn = stack[1][3]
-        if fn == "wait" and len(stack) > 2:
-            fn = stack[2][3]
+        frame = sys._getframe(1)
+        fn = frame.f_code.co_name
+        if fn == "wait" and frame.f_back is not None:
+            fn = frame.f_back.f_code.co_name
         self.err = f"Timeout {timeout} sec in '{fn}' function"
         self.timeout = timeout
 
@@ -118,17 +174,14 @@ class Timer:
         if monotonic() - self.start_time > self.timeout:
             raise TimeoutError(self.err)
 
-    def wait(self, delay: float = 0.001) -> bool:
-        sleep(delay)
-        if monotonic() - self.start_time > self.timeout:
-            raise TimeoutError(self.err)
-        return True
+
+# Коды месяцев фьючерсов: F - январь, ..., Z - декабрь
+FUTURES_MONTHS = {code: i + 1 for i, code in enumerate("FGHJKMNQUVXZ")}
 
 
 def parse_futures_ticker(local_symbol, decade=None) -> tuple[str, date]:
     symbol = local_symbol[:-2]
     year = int(local_symbol[-1])
-    months = "FGHJKMNQUVXZ"
     if decade:
         year += decade
     else:
@@ -137,12 +190,118 @@ def parse_futures_ticker(local_symbol, decade=None) -> tuple[str, date]:
             year += 2020
         else:
             year += 2010
-    month = months.index(local_symbol[-2]) + 1
-    expiration = datetime(year, month, 10).date()
+    month = FUTURES_MONTHS.get(local_symbol[-2])
+    if month is None:
+        raise ValueError(f"Unknown futures month code: {local_symbol}")
+    expiration = date(year, month, 10)
     return symbol, expiration
 
 
-@dataclass
+@lru_cache(maxsize=4096)
+def contract_template_for_sid(sid: str) -> Contract:
+    """
+    Шаблон Contract по строке SID в верхнем регистре.
+    Результат кэшируется и не должен изменяться.
+    """
+
+    contract = Contract()
+    parts = sid.split("_")
+
+    # cash
+    if parts[0] == "IDEALPRO" or "." in sid:
+        exch_str, security_str = parts
+        cur_1, cur_2 = security_str.split(".")
+        contract.secType = "CASH"
+        contract.symbol = cur_1
+        contract.exchange = exch_str
+        contract.primaryExchange = exch_str
+        contract.currency = cur_2
+
+    # crypto
+    elif parts[0] == "PAXOS":
+        exch_str, security_str = parts
+        contract.secType = "CRYPTO"
+        contract.symbol = security_str
+        contract.exchange = exch_str
+        contract.primaryExchange = exch_str
+        contract.currency = "USD"
+
+    # stocks
+    elif len(parts) == 2:
+        exch_str, security_str = parts
+        exch_str = exch_str.replace("NASDAQ", "ISLAND")
+        contract.secType = "STK"
+        contract.symbol = security_str
+        contract.exchange = "SMART"
+        contract.primaryExchange = exch_str
+        contract.currency = "USD"
+
+    # futures
+    elif len(parts) == 3:
+        exch_str, security_str, exp_str = parts
+        contract.secType = "FUT"
+        contract.symbol = security_str
+        contract.exchange = exch_str
+        contract.primaryExchange = exch_str
+        contract.currency = "USD"
+        contract.lastTradeDateOrContractMonth = f"20{exp_str}"
+
+    if contract.symbol:
+        return contract
+    else:
+        raise Exception(f"Can't make a contract from SID: {sid}")
+
+
+def expiry_yymm(expiry: str) -> str:
+    """
+    YYYYMMDD -> YYMM, без datetime.
+    Контракты с датой экспирации в конце месяца
+    почему-то называются по следующему месяцу.
+    """
+    year = int(expiry[:4])
+    month = int(expiry[4:6])
+    if int(expiry[6:8]) > 22:
+        month += 1
+        if month > 12:
+            month = 1
+            year += 1
+    return f"{year % 100:02d}{month:02d}"
+
+
+@lru_cache(maxsize=4096)
+def sid_for_fields(
+    sec_type: str, exchange: str, symbol: str, local_symbol: str, expiry: str
+) -> str:
+    """
+    SID по полям контракта, exchange - primaryExchange или exchange.
+    """
+    exchange = exchange.replace("ISLAND", "NASDAQ")
+
+    # STK, CRYPTO и остальные: биржа и символ
+    sid = f"{exchange}_{symbol}"
+
+    if sec_type == "FUT":
+        try:
+            _, exp_dt = parse_futures_ticker(local_symbol)
+            exp_str = f"{exp_dt.year % 100:02d}{exp_dt.month:02d}"
+        except:
+            exp_str = expiry
+            if len(exp_str) == 8:
+                exp_str = expiry_yymm(exp_str)
+            elif len(exp_str) == 6:
+                exp_str = exp_str[2:6]
+            else:
+                exp_str = exp_str[-4:]
+
+        sid = f"{sid}_{exp_str}"
+
+    elif sec_type == "CASH":
+        sid = f"{exchange}_{local_symbol}"
+
+    return sid.upper()
+
+
+@dataclass(slots=True)
 class Position:
     account: str
     contract: Contract
@@ -161,29 +320,78 @@ class Results:
 
     def __init__(self) -> None:
         self.requests_by_id: dict[int, Request] = {}
+        # Индексы по типу: id -> Request в порядке создания
+        self._by_type: defaultdict[str, dict[int, Request]] = defaultdict(dict)
+        self._active_by_type: defaultdict[str, dict[int, Request]] = defaultdict(dict)
+        # id запросов уникальны в пределах клиента
+        self._ids = count(10000000)
+        self._next_gc_at = monotonic() + REQUESTS_GC_INTERVAL
+        # Индексы меняются из потока пользователя и из потока сообщений IB
+        self._lock = threading.RLock()
 
     def request(self, type: str, id: int = 0):
-        # Удалить слишком старые запросы, если накопились
-        if len(self.requests_by_id) > 10:
-            old = datetime.utcnow() - timedelta(minutes=10)
-            for key, request in list(self.requests_by_id.items()):
-                if request.started_at < old:
-                    del self.requests_by_id[key]
-        # Новый запрос
-        if not id:
-            id = random.randint(10000000, 99999999)
-        # log.info(f"Start {type}, {id}")
-        self.requests_by_id[id] = Request(type, id)
-        return self.requests_by_id[id]
+        with self._lock:
+            # Удалить слишком старые запросы, не чаще раза в минуту
+            now = monotonic()
+            if now > self._next_gc_at:
+                self._gc(now)
+            # Новый запрос
+            if not id:
+                id = self.next_id()
+            # log.info(f"Start {type}, {id}")
+            if (old := self.requests_by_id.get(id)) is not None:
+                self._remove(old)
+            request = Request(type, id, results=self)
+            self.requests_by_id[id] = request
+            self._by_type[type][id] = request
+            self._active_by_type[type][id] = request
+            return request
+
+    def _gc(self, now: float) -> None:
+        self._next_gc_at = now + REQUESTS_GC_INTERVAL
+        old = now - REQUESTS_TTL
+        for request in list(self.requests_by_id.values()):
+            if request.created_at < old:
+                self._remove(request)
+
+    def next_id(self) -> int:
+        return next(self._ids)
+
+    def _remove(self, request: "Request") -> None:
+        with self._lock:
+            if self.requests_by_id.get(request.id) is request:
+                del self.requests_by_id[request.id]
+            by_type = self._by_type[request.type]
+            if by_type.get(request.id) is request:
+                del by_type[request.id]
+            self._deactivate(request)
+
+    def _deactivate(self, request: "Request") -> None:
+        with self._lock:
+            active = self._active_by_type[request.type]
+            if active.get(request.id) is request:
+                del active[request.id]
 
     def active(self, type: str | None = None) -> list["Request"]:
-        return self.filter(type=type, finished=False)
+        if type is None:
+            return self.filter(finished=False)
+        with self._lock:
+            return list(self._active_by_type[type].values())
+
+    def current(self, type: str) -> "Request | None":
+        """
+        Последний активный запрос этого типа.
+        """
+        with self._lock:
+            return next(reversed(self._active_by_type[type].values()), None)
 
     def get(self, id: int = 0) -> "Request":
-        return self.requests_by_id.get(id, Request())
+        # Пустой Request создается только при промахе
+        request = self.requests_by_id.get(id)
+        return Request() if request is None else request
 
     def finish(self, type: str | None = None) -> None:
-        for r in self.filter(type=type):
+        for r in self.active(type=type):
             r.finish()
 
     def filter(
@@ -193,7 +401,11 @@ class Results:
         type: str | None = None,
         before: datetime | None = None,
     ) -> list["Request"]:
-        res = list(self.requests_by_id.values())
+        with self._lock:
+            if type is not None:
+                res = list(self._by_type[type].values())
+            else:
+                res = list(self.requests_by_id.values())
 
         if id is not None:
             res = [o for o in res if o.id == id]
@@ -201,9 +413,6 @@ class Results:
         if finished is not None:
             res = [o for o in res if o.finished == finished]
 
-        if type is not None:
-            res = [o for o in res if o.type == type]
-
         if before is not None:
             res = [o for o in res if o.started_at < before]
 
@@ -218,13 +427,29 @@ class Request(list):
     Группа ответов идентифицируется по r_id.
     """
 
-    def __init__(self, type: str = "", id: int = 0):
+    __slots__ = (
+        "id",
+        "type",
+        "started_at",
+        "created_at",
+        "finished",
+        "code",
+        "error",
+        "_done",
+        "_results",
+    )
+
+    def __init__(self, type: str = "", id: int = 0, results: Results | None = None):
         self.id: int = id
         self.type: str = type
         self.started_at: datetime = datetime.utcnow()
+        self.created_at: float = monotonic()
         self.finished = False
         self.code: int = 0
         self.error: str = ""
+        self._done = threading.Event()
+        # Results, в индексах которого числится запрос
+        self._results = results
 
     def __str__(self) -> str:
         return (
@@ -236,12 +461,14 @@ class Request(list):
         return str(self)
 
     def wait(self, timeout: float = TIMEOUT):
-        with Timer(timeout) as t:
-            while not self.finished:
-                t.wait()
+        if not self._done.wait(timeout):
+            raise TimeoutError(Timer(timeout).err)
 
     def finish(self):
         self.finished = True
+        self._done.set()
+        if self._results is not None:
+            self._results._deactivate(self)
 
 
 class IBSync(IBClient):
@@ -252,56 +479,36 @@ class IBSync(IBClient):
         # Управление результатами запросов
         self.results = Results()
 
-        self._cached_details = {}
+        # contract_key -> детали контракта
+        self._cached_details: dict[tuple, list[ContractDetails]] = {}
 
         # TODO: приделать протухание
-        self._orders_by_pid = {}
-        self._positions_by_conid = {}
+        # Ордера, контракты и состояния по permId, в отдельных словарях
+        self._order_by_pid: dict[int, Order] = {}
+        self._contract_by_pid: dict[int, IbContract] = {}
+        self._state_by_pid: dict[int, OrderState] = {}
+        # Подписка reqPositions не отменяется, после первой выгрузки
+        # позиции обновляются в position()
+        self._positions_by_conid: dict[int, tuple] = {}
+        self._positions_ready = False
+
+    def connectionClosed(self):
+        super().connectionClosed()
+        # Подписка на позиции закрылась вместе с соединением
+        self._positions_ready = False
 
     @property
     def r_id(self):
-        return random.randint(10000000, 99999999)
+        return self.results.next_id()
 
     def sid_for_contract(self, contract: Contract) -> str:
-        exchange = str(contract.primaryExchange or contract.exchange)
-        symbol = str(contract.symbol)
-
-        exchange = exchange.replace("ISLAND", "NASDAQ")
-
-        sid = f"{exchange}_{symbol}"
-
-        if contract.secType == "STK":
-            sid = f"{exchange}_{symbol}"
-
-        elif contract.secType == "FUT":
-            try:
-                _, exp_dt = parse_futures_ticker(contract.localSymbol)
-                exp_str = exp_dt.strftime("%y%m")
-            except:
-                exp_str = contract.lastTradeDateOrContractMonth
-                if len(exp_str) == 8:
-                    exp_dt = datetime.strptime(exp_str, "%Y%m%d").date()
-                    # Контракты с датой экспирации в конце месяца
-                    # почему-то называются по следующему месяцу.
-                    if exp_dt.day > 22:
-                        exp_dt += timedelta(days=10)
-                    exp_str = exp_dt.strftime("%y%m")
-                elif len(exp_str) == 6:
-                    exp_dt = datetime.strptime(exp_str, "%Y%m").date()
-                    exp_str = exp_dt.strftime("%y%m")
-                else:
-                    exp_str = exp_str[-4:]
-
-            sid = f"{exchange}_{symbol}_{exp_str}"
-
-        elif contract.secType == "CRYPTO":
-            sid = f"{exchange}_{symbol}"
-
-        elif contract.secType == "CASH":
-            local_symbol = str(contract.localSymbol)
-            sid = f"{exchange}_{local_symbol}"
-
-        return sid.upper()
+        return sid_for_fields(
+            contract.secType,
+            str(contract.primaryExchange or contract.exchange),
+            str(contract.symbol),
+            str(contract.localSymbol),
+            contract.lastTradeDateOrContractMonth,
+        )
 
     def contract_for_sid(self, sid: str) -> Contract:
         """
@@ -309,54 +516,11 @@ class IBSync(IBClient):
 
         TODO: поддержка "FUT+CONTFUT" и/или "CONTFUT".
         """
-
-        sid = sid.upper()
-
-        contract = Contract()
-
-        # cash
-        if "IDEALPRO_" in sid or "." in sid:
-            exch_str, security_str = sid.split("_")
-            cur_1, cur_2 = security_str.split(".")
-            contract.secType = "CASH"
-            contract.symbol = cur_1
-            contract.exchange = exch_str
-            contract.primaryExchange = exch_str
-            contract.currency = cur_2
-
-        # crypto
-        elif "PAXOS_" in sid:
-            exch_str, security_str = sid.split("_")
-            contract.secType = "CRYPTO"
-            contract.symbol = security_str
-            contract.exchange = exch_str
-            contract.primaryExchange = exch_str
-            contract.currency = "USD"
-
-        # stocks
-        elif sid.count("_") == 1:
-            exch_str, security_str = sid.split("_")
-            exch_str = exch_str.replace("NASDAQ", "ISLAND")
-            contract.secType = "STK"
-            contract.symbol = security_str
-            contract.exchange = "SMART"
-            contract.primaryExchange = exch_str
-            contract.currency = "USD"
-
-        # futures
-        elif sid.count("_") == 2:
-            exch_str, security_str, exp_str = sid.split("_")
-            contract.secType = "FUT"
-            contract.symbol = security_str
-            contract.exchange = exch_str
-            contract.primaryExchange = exch_str
-            contract.currency = "USD"
-            contract.lastTradeDateOrContractMonth = f"20{exp_str}"
-
-        if contract.symbol:
-            return contract
-        else:
-            raise Exception(f"Can't make a contract from SID: {sid}")
+        # SID обычно уже в верхнем регистре, isupper не создает новую строку
+        if not sid.isupper():
+            sid = sid.upper()
+        # Разбор SID кэшируется, вызывающий получает свою копию
+        return copy(contract_template_for_sid(sid))
 
     ##########################
     ### Next Order ID
@@ -413,9 +577,10 @@ class IBSync(IBClient):
 
         self.reqAccountUpdates(True, self.account_id)
 
-        with Timer() as t:
-            while not (request_account.finished and request_portfolio.finished):
-                t.wait()
+        # Оба запроса завершает accountDownloadEnd, таймаут общий
+        deadline = monotonic() + TIMEOUT
+        request_account.wait()
+        request_portfolio.wait(max(0.0, deadline - monotonic()))
 
         # Представляете, так выглядит отписка!
         self.reqAccountUpdates(False, self.account_id)
@@ -423,8 +588,7 @@ class IBSync(IBClient):
         # qualify_contract занимает приличное время,
         # поэтому иногда лучше выключить
         if qualify:
-            for position in request_portfolio:
-                self.qualify_contract(position.contract)
+            self.qualify_contracts([p.contract for p in request_portfolio])
 
         # Распарсить ответы
         account_fields = {}
@@ -458,9 +622,9 @@ class IBSync(IBClient):
         if accountName != self.account_id:
             return
 
-        if requests := self.results.active(type="account"):
+        if (request := self.results.current("account")) is not None:
             # Данные добавляются в последний активный запрос
-            requests[-1].append(
+            request.append(
                 {
                     "key": key,
                     "value": value,
@@ -480,21 +644,13 @@ class IBSync(IBClient):
         realizedPNL: float,
         accountName: str,
     ):
-        super().updatePortfolio(
-            contract,
-            position,
-            marketPrice,
-            marketValue,
-            averageCost,
-            unrealizedPNL,
-            realizedPNL,
-            accountName,
-        )
+        # EWrapper только пишет в лог, вызов на каждую строку не нужен
+        # super().updatePortfolio(contract, position, marketPrice, ...)
 
         if accountName != self.account_id:
             return
 
-        if requests := self.results.active(type="portfolio"):
+        if (request := self.results.current("portfolio")) is not None:
             p = Position(
                 contract=contract,
                 amount=position,
@@ -505,7 +661,7 @@ class IBSync(IBClient):
                 realized_pnl=realizedPNL,
                 account=accountName,
             )
-            requests[-1].append(p)
+            request.append(p)
 
     def accountDownloadEnd(self, accountName: str):
         super().accountDownloadEnd(accountName)
@@ -516,33 +672,40 @@ class IBSync(IBClient):
     ### Positions
 
     def get_positions(self) -> list[tuple]:
+        if self._positions_ready:
+            # Снимок уже загруженных позиций, без запроса к TWS
+            rows = list(self._positions_by_conid.values())
+            self.qualify_contracts([contract for _, contract, _, _ in rows])
+            return rows
+
         self._positions_by_conid = {}
         request = self.results.request(type="positions")
         self.reqPositions()
 
         request.wait()
+        self._positions_ready = True
 
-        for _, contract, _, _ in request:
-            self.qualify_contract(contract)
+        self.qualify_contracts([contract for _, contract, _, _ in request])
 
         return list(request)
 
     def position(
         self, account: str, contract: Contract, position: Decimal, avgCost: float
     ):
-        super().position(account, contract, position, avgCost)
+        # super().position(account, contract, position, avgCost)
 
         if account != self.account_id:
             return
 
-        self._positions_by_conid[contract.conId] = (position, avgCost)
+        row = (account, contract, position, avgCost)
+        self._positions_by_conid[contract.conId] = row
 
-        if requests := self.results.active(type="positions"):
+        if (request := self.results.current("positions")) is not None:
             # Данные добавляются в последний активный запрос
-            requests[-1].append((account, contract, position, avgCost))
+            request.append(row)
 
     def positionEnd(self):
-        super().positionEnd()
+        # super().positionEnd()
         self.results.finish(type="positions")
 
     ##########################
@@ -553,9 +716,8 @@ class IBSync(IBClient):
 
         self.placeOrder(request.id, contract, order)
 
-        with Timer() as t:
-            while not (request.finished or len(request) > 0):
-                t.wait()
+        # Завершается первым openOrder или ошибкой
+        request.wait()
 
         for contract, _, _ in request:
             self.qualify_contract(contract)
@@ -564,7 +726,7 @@ class IBSync(IBClient):
             # TODO: передать code и msg
             raise Exception(request.error)
         else:
-            return list(request)[0]
+            return request[0]
 
     def get_orders(self):
         request_open_orders = self.results.request("open_orders")
@@ -579,17 +741,13 @@ class IBSync(IBClient):
         # т.к. openOrder вызывается другим потоком,
         # который заблокируется при любом запросе к IB
 
-        for contract, _, _ in request_open_orders:
-            self.qualify_contract(contract)
-
-        for contract, _, _ in request_completed_orders:
-            self.qualify_contract(contract)
-
-        for perm_id in self._orders_by_pid.keys():
-            _, contract, _ = self._orders_by_pid[perm_id]
-            self.qualify_contract(contract)
+        self.qualify_contracts(
+            [contract for contract, _, _ in request_open_orders]
+            + [contract for contract, _, _ in request_completed_orders]
+            + list(self._contract_by_pid.values())
+        )
 
-        return list(request_open_orders + request_completed_orders)
+        return [*request_open_orders, *request_completed_orders]
 
     def get_completed_api_orders(self):
         """
@@ -599,14 +757,10 @@ class IBSync(IBClient):
         self.reqCompletedOrders(apiOnly=False)  # not a subscription
         request.wait()
 
-        request.wait()
-
-        for contract, _, _ in request:
-            self.qualify_contract(contract)
-
-        for perm_id in self._orders_by_pid.keys():
-            _, contract, _ = self._orders_by_pid[perm_id]
-            self.qualify_contract(contract)
+        self.qualify_contracts(
+            [contract for contract, _, _ in request]
+            + list(self._contract_by_pid.values())
+        )
 
         return list(request)
 
@@ -632,11 +786,10 @@ class IBSync(IBClient):
         В openOrder приходят данные ордера и контракта, но нет
         оставшегося количества.
         """
-        if permId and permId in self._orders_by_pid:
-            order, contract, state = self._orders_by_pid[permId]
+        if permId and (state := self._state_by_pid.get(permId)) is not None:
             state.status = status
-            self.qualify_contract(contract)  # надеюсь, что это будет из кэша
-            self._orders_by_pid[permId] = order, contract, state
+            # надеюсь, что это будет из кэша
+            self.qualify_contract(self._contract_by_pid[permId])
         else:
             log.error(
                 f"Order not found in cache, perm: {permId}, "
@@ -644,37 +797,45 @@ class IBSync(IBClient):
             )
 
     def openOrder(self, orderId, contract, order, orderState):
-        super().openOrder(orderId, contract, order, orderState)
+        # super().openOrder(orderId, contract, order, orderState)
 
         # Ответ на place_order можно найти по id
         request = self.results.get(id=orderId)
 
         if not request.id:
             # Ответ на open_orders - по типу
-            if requests := self.results.active(type="open_orders"):
-                request = requests[-1]
+            if (current := self.results.current("open_orders")) is not None:
+                request = current
         request.append((contract, order, orderState))
+        if request.type == "place_order":
+            # place_order ждет только первый ответ
+            request.finish()
         if order.permId:
-            self._orders_by_pid[order.permId] = order, contract, orderState
+            self._store_order(order, contract, orderState)
         else:
             log.error(f"OpenOrder without permId: {order}")
 
     def completedOrder(self, contract, order, orderState):
-        super().completedOrder(contract, order, orderState)
-        if requests := self.results.active(type="completed_orders"):
+        # super().completedOrder(contract, order, orderState)
+        if (request := self.results.current("completed_orders")) is not None:
             # Данные добавляются в последний активный запрос
-            requests[-1].append((contract, order, orderState))
+            request.append((contract, order, orderState))
         if order.permId:
-            self._orders_by_pid[order.permId] = order, contract, orderState
+            self._store_order(order, contract, orderState)
         else:
             log.error(f"CompletedOrder without permId: {order}")
 
+    def _store_order(self, order, contract, orderState):
+        self._order_by_pid[order.permId] = order
+        self._contract_by_pid[order.permId] = contract
+        self._state_by_pid[order.permId] = orderState
+
     def openOrderEnd(self):
-        super().openOrderEnd()
+        # super().openOrderEnd()
         self.results.finish(type="open_orders")
 
     def completedOrdersEnd(self):
-        super().completedOrdersEnd()
+        # super().completedOrdersEnd()
         self.results.finish(type="completed_orders")
 
     ##########################
@@ -686,12 +847,11 @@ class IBSync(IBClient):
         # Эти результаты не завершаются каким-то отдельным событием
         request_commissions = self.results.request(type="commissions")
 
-        self.reqExecutions(request.id, ExecutionFilter())
+        self.reqExecutions(request.id, EMPTY_EXEC_FILTER)
 
         request.wait()
 
-        for contract, _, _ in request:
-            self.qualify_contract(contract)
+        self.qualify_contracts([contract for contract, _, _ in request])
 
         # Комиссионные репорты по id сделки
         commissions_by_exec_id = {}
@@ -721,9 +881,9 @@ class IBSync(IBClient):
         self.results.finish(type="commissions")
 
     def commissionReport(self, commissionReport):
-        if requests := self.results.active(type="commissions"):
+        if (request := self.results.current("commissions")) is not None:
             # Данные добавляются в последний активный запрос
-            requests[-1].append(commissionReport)
+            request.append(commissionReport)
 
     ##########################
     ### Contracts
@@ -732,7 +892,11 @@ class IBSync(IBClient):
         """
         Метод умеет разбирать очередь сообщений в своем потоке.
         """
+        request = self._request_contract_details(contract)
+        self._pump_contract_details([request])
+        return list(request)
 
+    def _request_contract_details(self, contract: Contract) -> Request:
         if contract.exchange == "NASDAQ":
             contract.exchange = "ISLAND"
         if contract.primaryExchange == "NASDAQ":
@@ -742,35 +906,82 @@ class IBSync(IBClient):
 
         self.reqContractDetails(request.id, contract)
 
-        with Timer() as t:
-            # Разбор очереди сообщений от GW.
-            # Обрабатываются только сообщения про контракт.
-            while not request.finished:
-                try:
-                    text = self.msg_queue.get(block=True, timeout=0.2)
-                except queue.Empty:
-                    pass
-                else:
-                    f = read_fields(text)
-                    # Details
-                    if f[0] == b"10" and f[1]:
-                        self.decoder.interpret(f)  # type: ignore
-                    # DetailsEnd
-                    elif f[0] == b"52" and f[2]:
-                        self.decoder.interpret(f)  # type: ignore
-                    # Другие сообщения возвращаются в очередь
-                    else:
-                        self.msg_queue.put(text, block=True, timeout=0.1)
-                t.wait()
+        return request
 
-        return list(request)
+    def _pump_contract_details(self, requests: list[Request]) -> None:
+        """
+        Разбирает очередь сообщений, пока не завершатся все запросы.
+        """
+        # Большой пачке нужно время еще и на ограничение частоты в TWS
+        timeout = TIMEOUT + len(requests) / DETAILS_BATCH_SIZE
+
+        run_thread_id = self.run_thread_id
+        if run_thread_id is not None and run_thread_id != threading.get_ident():
+            # Очередь разбирает run() в другом потоке,
+            # достаточно дождаться завершения запросов
+            deadline = monotonic() + timeout
+            for r in requests:
+                r.wait(max(0.0, deadline - monotonic()))
+            return
+
+        # Другие сообщения откладываются и возвращаются в очередь в конце,
+        # иначе без другого читателя одно и то же сообщение крутится по кругу
+        holdover = []
+        pending = [r for r in requests if not r.finished]
+        pending_ids = {str(r.id).encode() for r in pending}
+        get = self.msg_queue.get
+        decoder = self.decoder
+        try:
+            with Timer(timeout) as t:
+                deadline = t.start_time + t.timeout
+                # Разбор очереди сообщений от GW.
+                # Обрабатываются только сообщения про контракт.
+                # Других читателей нет, запросы завершаются только здесь,
+                # поэтому get можно ждать до самого дедлайна.
+                while pending:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError(t.err)
+                    try:
+                        text = get(block=True, timeout=remaining)
+                    except queue.Empty:
+                        pass
+                    else:
+                        # Чужие сообщения не разбираются целиком, хватает msgId
+                        msg_id = text[: text.find(b"\0")]
+                        if msg_id in (b"10", b"52", b"4"):
+                            f = read_fields(text)
+                        else:
+                            f = None
+                        # Details
+                        if msg_id == b"10" and f[1]:
+                            decoder.interpret(f)  # type: ignore
+                        # DetailsEnd
+                        elif msg_id == b"52" and f[2]:
+                            decoder.interpret(f)  # type: ignore
+                            pending = [r for r in pending if not r.finished]
+                        # Ошибка по запросу тоже его завершает,
+                        # иначе ожидание длится до таймаута
+                        elif msg_id == b"4" and f[2] in pending_ids:
+                            decoder.interpret(f)  # type: ignore
+                            pending = [r for r in pending if not r.finished]
+                        else:
+                            holdover.append(text)
+        finally:
+            if holdover:
+                # Отложенные сообщения старше тех, что пришли за это время,
+                # поэтому возвращаются в начало очереди в исходном порядке
+                q = self.msg_queue
+                with q.mutex:
+                    q.queue.extendleft(reversed(holdover))
+                    q.unfinished_tasks += len(holdover)
+                    q.not_empty.notify(len(holdover))
 
     def contractDetails(self, reqId: int, contractDetails: ContractDetails):
         # Все результаты кешируются по conId
-        c = Contract(**contractDetails.contract.__dict__)
-        h = hash(c)
-        if h not in self._cached_details:
-            self._cached_details[h] = [contractDetails]
+        key = contract_key(contractDetails.contract)
+        if key not in self._cached_details:
+            self._cached_details[key] = [contractDetails]
         request = self.results.get(id=reqId)
         if request.finished:
             log.error(f"contractDetails request is already finished: {reqId}")
@@ -778,25 +989,85 @@ class IBSync(IBClient):
             request.append(contractDetails)
 
     def contractDetailsEnd(self, reqId: int):
-        sleep(0.01)  # время на обработку contractDetails другим потоком
         self.results.get(id=reqId).finish()
 
-    def _get_cached_details(self, contract: Contract) -> list[ContractDetails]:
+    def _details_query(self, contract: Contract) -> Contract:
+        """
+        Контракт для запроса деталей и поиска в кэше.
+        """
         if contract.conId:
             c = Contract(conId=contract.conId)
+        elif isinstance(contract, Contract):
+            c = copy(contract)
+            c.includeExpired = True
         else:
             c = Contract(**contract.__dict__)
             c.includeExpired = True
+        return c
+
+    def _get_cached_details(self, contract: Contract) -> list[ContractDetails]:
+        key = contract_key(contract)
 
-        if hash(c) in self._cached_details:
-            return self._cached_details[hash(c)]
+        if (details := self._cached_details.get(key)) is not None:
+            return details
 
-        log.warning(f"MISS: {c}, h: {hash(c)}")
+        c = self._details_query(contract)
+
+        log.warning(f"MISS: {c}")
 
         result = self.get_contract_details(c)
+        if result:
+            self._cached_details.setdefault(key, result)
 
         return result
 
+    def qualify_contracts(self, contracts, keep_exchange=False) -> None:
+        """
+        Как qualify_contract, но детали всех контрактов, которых нет
+        в кэше, запрашиваются разом, и очередь разбирается один раз.
+        """
+        # Один и тот же объект часто приходит из нескольких списков
+        seen = set()
+        unique = []
+        for c in contracts:
+            if id(c) not in seen and not getattr(c, "details", None):
+                seen.add(id(c))
+                unique.append(c)
+        contracts = unique
+
+        queries = {}
+        for contract in contracts:
+            key = contract_key(contract)
+            if key not in self._cached_details and key not in queries:
+                queries[key] = self._details_query(contract)
+
+        # Пустые ответы запоминаются, чтобы не спрашивать TWS второй раз
+        failed = {}
+        items = list(queries.items())
+        batch_started_at = None
+        for i in range(0, len(items), DETAILS_BATCH_SIZE):
+            # Не больше одной пачки в секунду, иначе TWS превысит лимит
+            if batch_started_at is not None:
+                if (pause := batch_started_at + 1.0 - monotonic()) > 0:
+                    sleep(pause)
+            batch_started_at = monotonic()
+            requests = {
+                key: self._request_contract_details(c)
+                for key, c in items[i : i + DETAILS_BATCH_SIZE]
+            }
+            self._pump_contract_details(list(requests.values()))
+            for key, request in requests.items():
+                if request:
+                    self._cached_details.setdefault(key, list(request))
+                else:
+                    failed[key] = request
+
+        for contract in contracts:
+            if (request := failed.get(contract_key(contract))) is not None:
+                error = f", {request.error}" if request.error else ""
+                raise ValueError(f"Unknown contract: {contract}{error}")
+            self.qualify_contract(contract, keep_exchange)
+
     def qualify_contract(self, contract: Contract, keep_exchange=False) -> Contract:
         """
         IB возвращает контракты с пустыми полями, нужно их заполнять.
@@ -827,10 +1098,9 @@ class IBSync(IBClient):
                 # overwriting 'SMART' exchange can create invalid contract
                 c.exchange = contract.exchange
 
-            for k, v in c.__dict__.items():
-                setattr(contract, k, v)
-
-            setattr(contract, "details", details[0])
+            attrs = contract.__dict__
+            attrs.update(c.__dict__)
+            attrs["details"] = details[0]
 
         return contract
 
@@ -855,6 +1125,69 @@ class IBSync(IBClient):
         You can also provide yyyymmddd-hh:mm:ss time is in UTC.
         Note that there is a dash between the date and time in UTC notation.
         """
+        request = self._request_historical_data(
+            contract, end_dt, duration, bar_size, data_type, use_rth
+        )
+        request.wait(timeout)
+        return self._historical_result(request)
+
+    def get_historical_data_batch(
+        self,
+        contracts: list[Contract],
+        end_dt: str,
+        duration: str = "300 S",
+        bar_size: str = "1 min",
+        data_type: str = "TRADES",
+        use_rth: int = 0,
+        timeout: float = TIMEOUT,
+    ) -> list[list[BarData] | Exception]:
+        """
+        То же, что get_historical_data, для нескольких контрактов.
+        Запросы уходят пачками, не дожидаясь ответов на предыдущие.
+        Результаты в порядке contracts. Ошибка одного запроса
+        (например, pacing violation) не теряет остальные:
+        на ее месте в результатах стоит исключение.
+        timeout ограничивает ожидание ответов всей пачки,
+        запросы без ответа за это время отменяются.
+        """
+        results = []
+        for i in range(0, len(contracts), HISTORICAL_MAX_REQUESTS):
+            requests = [
+                self._request_historical_data(
+                    contract, end_dt, duration, bar_size, data_type, use_rth
+                )
+                for contract in contracts[i : i + HISTORICAL_MAX_REQUESTS]
+            ]
+            # TWS обрабатывает запросы пачки параллельно, срок у них общий
+            deadline = monotonic() + timeout
+            for request in requests:
+                try:
+                    request.wait(max(0.0, deadline - monotonic()))
+                except TimeoutError as e:
+                    # Иначе поздние бары так и будут приходить по этому id
+                    self.cancelHistoricalData(request.id)
+                    request.finish()
+                    log.error(f"Historical data request {request.id} failed: {e}")
+                    results.append(e)
+                    continue
+                if request.error and "query returned no data" not in request.error:
+                    log.error(
+                        f"Historical data request {request.id} failed: {request.error}"
+                    )
+                    results.append(Exception(request.error))
+                else:
+                    results.append(self._historical_result(request))
+        return results
+
+    def _request_historical_data(
+        self,
+        contract: Contract,
+        end_dt: str,
+        duration: str,
+        bar_size: str,
+        data_type: str,
+        use_rth: int,
+    ) -> Request:
         if contract.secType == "CRYPTO" and data_type == "TRADES":
             data_type = "AGGTRADES"
 
@@ -873,8 +1206,9 @@ class IBSync(IBClient):
             chartOptions=[],
         )
 
-        request.wait(timeout)
+        return request
 
+    def _historical_result(self, request: Request) -> list[BarData]:
         if request.error:
             if "query returned no data" in request.error:
                 return []
@@ -901,7 +1235,7 @@ class IBSync(IBClient):
         request = self.results.request("head_timestamp")
         self.reqHeadTimeStamp(request.id, contract, whatToShow, useRTH, formatDate)
         request.wait()
-        return list(request)[0]
+        return request[0]
 
     def headTimestamp(self, reqId: int, headTimestamp: str):
         request = self.results.get(id=reqId)
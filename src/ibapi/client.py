@@ -16,6 +16,7 @@ The user just needs to override EWrapper methods to receive the answers.
 import logging
 import queue
 import socket
+import threading
 
 from ibapi import (decoder, reader, comm)
 from ibapi.connection import Connection
@@ -43,6 +44,9 @@ class EClient(object):
 
     def __init__(self, wrapper):
         self.msg_queue = queue.Queue()
+        # Поток, в котором сейчас крутится run(). Пока он есть,
+        # другие потоки не разбирают msg_queue сами (IBSync).
+        self.run_thread_id = None
         self.wrapper = wrapper
         self.decoder = None
         self.reset()
@@ -244,6 +248,7 @@ class EClient(object):
     def run(self):
         """This is the function that has the message loop."""
 
+        self.run_thread_id = threading.get_ident()
         try:
             while self.isConnected() or not self.msg_queue.empty():
                 try:
@@ -268,10 +273,12 @@ class EClient(object):
                 except BadMessage:
                     logger.info("BadMessage")
 
-                logger.debug("conn:%d queue.sz:%d",
-                             self.isConnected(),
-                             self.msg_queue.qsize())
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("conn:%d queue.sz:%d",
+                                 self.isConnected(),
+                                 self.msg_queue.qsize())
         finally:
+            self.run_thread_id = None
             self.disconnect()
 
 
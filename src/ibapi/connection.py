@@ -23,6 +23,9 @@ from ibapi.common import NO_VALID_ID
 
 logger = logging.getLogger(__name__)
 
+RCVBUF_SIZE = 4 * 1024 * 1024
+RECV_CHUNK_SIZE = 64 * 1024
+
 
 class Connection:
     def __init__(self, host, port):
@@ -31,6 +34,9 @@ class Connection:
         self.socket: socket.socket | None = None
         self.wrapper = None
         self.lock = threading.Lock()
+        # Один буфер на соединение, recv_into без новых bytes на каждый вызов
+        self._recv_buf = bytearray(RECV_CHUNK_SIZE)
+        self._recv_view = memoryview(self._recv_buf)
 
     def connect(self):
         try:
@@ -44,6 +50,11 @@ class Connection:
         # FIXME: почему это не было сделано?
         self.socket.settimeout(1)
 
+        # Сообщения короткие, задержка Nagle не нужна.
+        # Буфер побольше для выгрузки исторических данных.
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF_SIZE)
+
         try:
             self.socket.connect((self.host, self.port))
         except socket.error:
@@ -121,16 +132,20 @@ class Connection:
         return buf
 
     def _recvAllMsg(self):
-        cont = True
-        allbuf = b""
-
-        while cont and self.isConnected() and self.socket:
-            buf = self.socket.recv(4096)
-            allbuf += buf
-            logger.debug("len %d raw:%s|", len(buf), buf)
-
-            if len(buf) < 4096:
-                cont = False
-
-        return allbuf
+        view = self._recv_view
+        chunks = []
+
+        while self.isConnected() and self.socket:
+            n = self.socket.recv_into(view)
+            # Единственная копия из общего буфера
+            chunks.append(view[:n].tobytes())
+            logger.debug("len %d", n)
+
+            if n < RECV_CHUNK_SIZE:
+                break
+
+        # Обычно все приходит за один recv, склеивать нечего
+        if len(chunks) == 1:
+            return chunks[0]
+        return b"".join(chunks)
 
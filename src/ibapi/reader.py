@@ -12,13 +12,14 @@ remove the size prefix and put the rest in a Queue.
 """
 
 import logging
+import struct
 from threading import Thread
 
-from ibapi import comm
-
 
 logger = logging.getLogger(__name__)
 
+HEADER = struct.Struct("!I")
+
 
 class EReader(Thread):
     def __init__(self, conn, msg_queue):
@@ -29,24 +30,27 @@ class EReader(Thread):
     def run(self):
         try:
             logger.debug("EReader thread started")
-            buf = b""
+            buf = bytearray()
             while self.conn.isConnected():
 
                 data = self.conn.recvMsg()
                 logger.debug("reader loop, recvd size %d", len(data))
                 buf += data
 
-                while len(buf) > 0:
-                    (size, msg, buf) = comm.read_msg(buf)
-                    #logger.debug("resp %s", buf.decode('ascii'))
-                    logger.debug("size:%d msg.size:%d msg:|%s| buf:%s|", size,
-                        len(msg), buf, "|")
-
-                    if msg:
-                        self.msg_queue.put(msg)
-                    else:
+                # Целые сообщения вырезаются по смещению,
+                # хвост буфера сдвигается один раз за чтение
+                pos = 0
+                end = len(buf)
+                while end - pos >= 4:
+                    (size,) = HEADER.unpack_from(buf, pos)
+                    if end - pos - 4 < size:
                         logger.debug("more incoming packet(s) are needed ")
                         break
+                    pos += 4
+                    if size:
+                        self.msg_queue.put(bytes(buf[pos:pos + size]))
+                    pos += size
+                del buf[:pos]
 
             logger.debug("EReader thread finished")
         except:
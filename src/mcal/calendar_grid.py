@@ -1,5 +1,7 @@
-from datetime import datetime, timedelta, timezone
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache
 
+import numpy as np
 import pandas_market_calendars as mcal
 
 from .rules import *
@@ -23,18 +25,92 @@ IBKR_TO_MCAL = {
 #     print(n)
 
 
+# Инструменты со своим календарем
+SYMBOL_TO_MCAL = {
+    ("CBOT", "ZR"): "CBOTRiseFutures",
+    ("NYMEX", "NG"): "CMEGlobex_NG",
+}
+
+
+@lru_cache(maxsize=4096)
 def get_mcal_exchange(sid: str) -> str:
-    exchange, rest = sid.split("_", 1)
-    symbol = rest.split("_")[0]
-    if exchange == "CBOT" and symbol == "ZR":
-        exchange = "CBOTRiseFutures"
-    elif exchange == "NYMEX" and symbol == "NG":
-        exchange = "CMEGlobex_NG"
-    elif symbol == "EUR.NZD":
-        exchange = "ForexEURNZD"
-    elif exchange in IBKR_TO_MCAL:
-        exchange = IBKR_TO_MCAL[exchange]
-    return exchange
+    exchange, symbol = sid.split("_", 2)[:2]
+    if (name := SYMBOL_TO_MCAL.get((exchange, symbol))) is not None:
+        return name
+    if symbol == "EUR.NZD":
+        return "ForexEURNZD"
+    return IBKR_TO_MCAL.get(exchange, exchange)
+
+
+@lru_cache(maxsize=None)
+def get_mcal_calendar(exchange: str) -> mcal.MarketCalendar:
+    return mcal.get_calendar(exchange)  # type: ignore
+
+
+def _seconds(column) -> np.ndarray:
+    return column.values.astype("datetime64[s]").astype(np.int64)
+
+
+def _session_bounds(schedule) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Границы торговых отрезков в секундах, перерыв делит сессию на два.
+    """
+    opens = _seconds(schedule["market_open"])
+    closes = _seconds(schedule["market_close"])
+    if "break_start" not in schedule.columns:
+        return opens, closes
+
+    has_break = (schedule["break_start"].notna() & schedule["break_end"].notna()).values
+    break_start = np.minimum(_seconds(schedule["break_start"]), closes)
+    break_end = np.maximum(_seconds(schedule["break_end"]), opens)
+    # Без перерыва второй отрезок пустой
+    starts = np.concatenate([opens, np.where(has_break, break_end, closes)])
+    ends = np.concatenate([np.where(has_break, break_start, closes), closes])
+    return starts, ends
+
+
+def _minute_starts(starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """
+    То же, что mcal.date_range(schedule, "1T", force_close=True) минус минута,
+    без промежуточных Timestamp: метки start, start + 60, ... до end
+    и end - 60, если end не попадает на минуту.
+    """
+    ok = ends > starts
+    starts, ends = starts[ok], ends[ok]
+    counts = (ends - starts) // 60
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    minutes = np.repeat(starts, counts) + 60 * offsets
+    tails = ends[(ends - starts) % 60 != 0] - 60
+    return np.concatenate([minutes, tails])
+
+
+@lru_cache(maxsize=64)
+def _get_grid(exchange: str, date_1: date, date_2: date) -> np.ndarray:
+    """
+    Рабочие минутные интервалы от date_1 до date_2 в виде
+    отсортированного массива timestamps.
+    Сетка общая для всех CalendarGrid с тем же периодом.
+    """
+    calendar = get_mcal_calendar(exchange)
+
+    # Расписание нужной биржи (все доступные интервалы)
+    schedule = calendar.schedule(date_1, date_2)  # market_times="all"
+
+    # Минутные интервалы ETH
+    # times = calendar.regular_market_times
+    # if "pre" in times and "post" in times:
+    #     schedule[["market_open", "market_close"]] = schedule[["pre", "post"]]
+
+    # Минутные интервалы RTH
+    starts, ends = _session_bounds(schedule)
+
+    # Смещение на одну минуту нужно, чтобы интервал
+    # HH:00 был как следующие интервалы этого часа
+    res = np.unique(_minute_starts(starts, ends))
+    # Массив общий для всех сеток из кэша
+    res.flags.writeable = False
+
+    return res
 
 
 class CalendarGrid:
@@ -50,43 +126,43 @@ class CalendarGrid:
         else:
             self.dt_2 = datetime.today() + timedelta(days=300)
         self.grids = self._init_grids(sids)
+        # is_rth обычно вызывается подряд для одного инструмента.
+        # Пара (sid, grid) меняется одним присваиванием, без рассинхрона
+        # между потоками.
+        self._last: tuple[str | None, np.ndarray | None] = (None, None)
 
-    def _init_grids(self, sids: list[str]) -> dict:
+    def _init_grids(self, sids: list[str]) -> dict[str, np.ndarray]:
         res = {}
         for sid in sids:
             exchange = get_mcal_exchange(sid)
             if exchange in res:
                 continue
-            calendar = self.get_calendar(sid)
-            res[exchange] = self._get_grid(calendar)
+            res[exchange] = self._get_grid(exchange)
         return res
 
-    def _get_grid(self, calendar: mcal.MarketCalendar) -> set[int]:
-        """
-        Рабочие минутные интервалы от dt_1 до dt_2 в виде списка timestamps.
-        """
-        # Расписание нужной биржи (все доступные интервалы)
-        schedule = calendar.schedule(self.dt_1, self.dt_2)  # market_times="all"
-
-        # Минутные интервалы ETH
-        # times = calendar.regular_market_times
-        # if "pre" in times and "post" in times:
-        #     schedule[["market_open", "market_close"]] = schedule[["pre", "post"]]
-
-        # Минутные интервалы RTH
-        open = mcal.date_range(schedule, "1T", force_close=True)
-
-        # Смещение на одну минуту нужно, чтобы интервал
-        # HH:00 был как следующие интервалы этого часа
-        res = {dt - 60 for dt in set(open.view("int64") // 10**9)}
-
-        return res
+    def _get_grid(self, exchange: str) -> np.ndarray:
+        # schedule работает с датами, поэтому ключ кэша - даты периода
+        return _get_grid(exchange, self.dt_1.date(), self.dt_2.date())
 
     def get_calendar(self, sid: str) -> mcal.MarketCalendar:
         exchange = get_mcal_exchange(sid)
-        return mcal.get_calendar(exchange)  # type: ignore
+        return get_mcal_calendar(exchange)
+
+    def get_grid(self, sid: str) -> np.ndarray:
+        """
+        Сетка инструмента, чтобы не искать ее заново на каждом баре.
+        """
+        return self.grids[get_mcal_exchange(sid)]
 
     def is_rth(self, sid: str, dt: datetime) -> bool:
-        exchange = get_mcal_exchange(sid)
-        dt = dt.replace(second=0).replace(tzinfo=timezone.utc)
-        return int(dt.timestamp()) in self.grids[exchange]
+        # Время dt считается UTC, секунды отбрасываются
+        ts = int(dt.replace(tzinfo=timezone.utc).timestamp())
+        ts -= ts % 60
+        last = self._last
+        if last[0] == sid:
+            grid = last[1]
+        else:
+            grid = self.get_grid(sid)
+            self._last = (sid, grid)
+        i = grid.searchsorted(ts)  # type: ignore
+        return bool(i < grid.size and grid[i] == ts)
@@ -0,0 +1,6 @@
+from pandas import date_range
+
+# Общие для всех правил дни недели
+mondays = date_range("2020-01-01", "2030-01-01", freq="W-MON")
+fridays = date_range("2020-01-01", "2030-01-01", freq="W-FRI")
+sundays = date_range("2020-01-01", "2030-01-01", freq="W-SUN")
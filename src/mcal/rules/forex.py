@@ -1,11 +1,9 @@
 from datetime import time
 from zoneinfo import ZoneInfo
 
-from pandas import date_range
 from pandas_market_calendars.calendar_registry import CMEGlobexFXExchangeCalendar
 
-mondays = date_range("2020-01-01", "2030-01-01", freq="W-MON")
-fridays = date_range("2020-01-01", "2030-01-01", freq="W-FRI")
+from ._weekdays import fridays, mondays
 
 
 class Forex(CMEGlobexFXExchangeCalendar):
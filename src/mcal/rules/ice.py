@@ -1,10 +1,9 @@
 from datetime import time
 from zoneinfo import ZoneInfo
 
-from pandas import date_range
 from pandas_market_calendars.exchange_calendar_ice import ICEExchangeCalendar
 
-mondays = date_range("2020-01-01", "2030-01-01", freq="W-MON")
+from ._weekdays import mondays
 
 
 class ICEUSFutures(ICEExchangeCalendar):
@@ -1,12 +1,9 @@
 from datetime import time
 from zoneinfo import ZoneInfo
 
-from pandas import date_range
-from pandas.tseries.offsets import CustomBusinessDay
 from pandas_market_calendars import MarketCalendar
 
-mask_sun = CustomBusinessDay(weekmask="Sun")  # type: ignore
-sundays = date_range("2020-01-01", "2030-01-01", freq=mask_sun)
+from ._weekdays import sundays
 
 
 class Paxos(MarketCalendar):